@@ -4,7 +4,8 @@ Script for (somewhat safely) adding metadata required by BigDataViewer
 (and optionally n5-viewer) to multiscale datasets stored in N5 containers.
 """
 from dataclasses import dataclass
-import json
+from functools import lru_cache, partial
+import os
 from pathlib import Path
 from argparse import ArgumentParser
 import re
@@ -12,14 +13,35 @@ import typing as tp
 from collections.abc import MutableMapping
 import logging
 
+from n5_common import ATTRS_FILE, ARRAY_ATTR_KEYS, get_executor
+
+try:
+    import orjson
+
+    _loads = orjson.loads
+
+    def _dumps(d, pretty=False) -> bytes:
+        option = orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS if pretty else 0
+        return orjson.dumps(d, option=option)
+
+except ImportError:
+    import json
+
+    _loads = json.loads
+
+    def _dumps(d, pretty=False) -> bytes:
+        kwargs = {"sort_keys": True, "indent": 2} if pretty else {}
+        return json.dumps(d, **kwargs).encode()
+
+
 logger = logging.getLogger(__name__)
 
-ATTRS_FILE = "attributes.json"
-ARRAY_ATTR_KEYS = {"dimensions", "dataType", "blockSize", "compression"}
 SCALE_RE = re.compile(r"s(\d+)")
-unit_re_str = r"([YZEPTGMkhdcmuμnpfazy]|da)?(m|s|Hz)"
+UNIT_PREFIXES = tuple("YZEPTGMkhdcmuμnpfazy") + ("da",)
+UNIT_BASES = ("m", "s", "Hz")
+unit_re_str = "({})?({})".format("|".join(UNIT_PREFIXES), "|".join(UNIT_BASES))
 UNIT_RE = re.compile(unit_re_str)
-RESOLUTION_RE = re.compile(r"(?P<value>(\d*\.?)?\d+)\s*(?P<unit>" + unit_re_str + ")?")
+UNITS = frozenset(p + b for p in ("",) + UNIT_PREFIXES for b in UNIT_BASES)
 
 Jso = tp.Optional[tp.Union[tp.Dict[str, "Jso"], tp.List["Jso"], int, float, bool, str]]
 
@@ -29,16 +51,29 @@ def check_key(k: str):
         raise TypeError(f"Not a valid key: {repr(k)}")
 
 
+_LEAF_TYPES = (int, float, bool, str, bytes, type(None))
+_LEAF_TYPE_SET = frozenset(_LEAF_TYPES)
+
+
 def check_value(v: Jso):
-    if isinstance(v, list):
-        for item in v:
-            check_value(item)
-    elif isinstance(v, dict):
-        for k, val in v.items():
-            check_key(k)
-            check_value(val)
-    elif v is not None and not isinstance(v, (int, float, bool, str, bytes)):
-        raise TypeError(f"Not a valid value: {repr(v)}")
+    _isinstance = isinstance
+    _check_key = check_key
+    leaf_types = _LEAF_TYPES
+    stack = [v]
+    while stack:
+        v = stack.pop()
+        if _isinstance(v, leaf_types):
+            continue
+        if _isinstance(v, list):
+            # lists of exact scalar types (the usual case) are accepted in one C-level pass
+            if not _LEAF_TYPE_SET.issuperset(map(type, v)):
+                stack.extend(v)
+        elif _isinstance(v, dict):
+            for k, val in v.items():
+                _check_key(k)
+                stack.append(val)
+        else:
+            raise TypeError(f"Not a valid value: {repr(v)}")
 
 
 class ArrayAttrs(tp.TypedDict):
@@ -49,8 +84,10 @@ class ArrayAttrs(tp.TypedDict):
 
 
 class N5Attrs(MutableMapping):
-    def __init__(self, d: tp.Dict[str, Jso], gentle=True) -> None:
-        check_value(d)
+    def __init__(self, d: tp.Dict[str, Jso], gentle=True, _trusted=False) -> None:
+        # _trusted: d was freshly decoded from JSON, so cannot contain invalid values
+        if not _trusted:
+            check_value(d)
         self._d: tp.Dict[str, Jso] = d
         self.gentle = gentle
 
@@ -71,28 +108,30 @@ class N5Attrs(MutableMapping):
 
     @classmethod
     def from_dir(cls, dpath: Path, gentle=True):
-        if not dpath.is_dir():
+        try:
+            f = open(dpath / ATTRS_FILE, "rb")
+        except FileNotFoundError:
+            # distinguish a group without attributes from a missing group
+            if not dpath.is_dir():
+                raise FileNotFoundError(f"Directory does not exist: {dpath}")
+            return cls(dict(), gentle)
+        except NotADirectoryError:
             raise FileNotFoundError(f"Directory does not exist: {dpath}")
-        attr_path = dpath / ATTRS_FILE
-        if not attr_path.is_file():
+        except IsADirectoryError:
             return cls(dict(), gentle)
-        with open(dpath / ATTRS_FILE) as f:
-            d = json.load(f)
-        return cls(d, gentle)
+        with f:
+            d = _loads(f.read())
+        return cls(d, gentle, _trusted=True)
 
     def to_dir(self, dpath: Path, pretty=True, dry_run=False):
-        if pretty:
-            kwargs = {"sort_keys": True, "indent": 2}
-        else:
-            kwargs = {}
-        s = json.dumps(self._d, **kwargs)
+        b = _dumps(self._d, pretty)
         fpath = dpath / ATTRS_FILE
         if dry_run:
             logger.info("Dry-run mode: would write to %s", fpath)
-            print(s)
+            print(b.decode("utf-8"))
         else:
-            with open(fpath, "w") as f:
-                f.write(s)
+            with open(fpath, "wb") as f:
+                f.write(b)
 
     def __iter__(self):
         return self._d.__iter__()
@@ -112,7 +151,7 @@ class N5Attrs(MutableMapping):
             raise ValueError(f"Cannot delete key: '{key}'")
         return super().__delitem__(key)
 
-    def __setitem__(self, key: str, value: Jso):
+    def _check_writable_key(self, key: str):
         check_key(key)
         if key in ARRAY_ATTR_KEYS:
             raise ValueError(f"Cannot write reserved keys: '{key}'")
@@ -125,9 +164,21 @@ class N5Attrs(MutableMapping):
             else:
                 logger.warning(key_msg)
 
+    def __setitem__(self, key: str, value: Jso):
+        self._check_writable_key(key)
         check_value(value)
         return self._d.__setitem__(key, value)
 
+    def update_trusted(self, mapping: tp.Mapping[str, Jso]):
+        """Like update(), but without validating values.
+
+        Keys are checked as in __setitem__, before anything is written.
+        Only for values built in-process from plain JSON-compatible types.
+        """
+        for key in mapping:
+            self._check_writable_key(key)
+        self._d.update(mapping)
+
 
 def infer_downsampling_factor(s0_shape, sN_shape) -> tp.List[int]:
     if len(s0_shape) != len(sN_shape):
@@ -135,14 +186,44 @@ def infer_downsampling_factor(s0_shape, sN_shape) -> tp.List[int]:
     return [round(s0 / sN) for s0, sN in zip(s0_shape, sN_shape)]
 
 
-def get_downsampling_factors(dpath: Path) -> tp.Optional[tp.List[tp.List[int]]]:
-    scale = 0
+def list_scales(dpath: Path) -> tp.List[int]:
+    levels = set()
+    with os.scandir(dpath) as it:
+        for entry in it:
+            m = SCALE_RE.fullmatch(entry.name)
+            if m is not None:
+                levels.add(int(m.group(1)))
+    return sorted(levels)
+
+
+def _read_scale(dpath: Path, scale: int) -> tp.Optional[N5Attrs]:
     try:
-        attrs = N5Attrs.from_dir(dpath / f"s{scale}")
+        return N5Attrs.from_dir(dpath / f"s{scale}")
     except FileNotFoundError:
+        return None
+
+
+def get_downsampling_factors(dpath: Path) -> tp.Optional[tp.List[tp.List[int]]]:
+    try:
+        levels = set(list_scales(dpath))
+    except (FileNotFoundError, NotADirectoryError):
+        logger.info("Group does not exist")
+        return None
+
+    n_scales = 0
+    while n_scales in levels:
+        n_scales += 1
+
+    if n_scales == 0:
         logger.info("Group has no child 's0'")
         return None
 
+    scale_attrs = get_executor().map(partial(_read_scale, dpath), range(n_scales))
+
+    attrs = next(scale_attrs)
+    if attrs is None:
+        logger.info("Group has no child 's0'")
+        return None
     if not attrs.is_array():
         logger.info("Child 's0' is not an array")
         return None
@@ -150,13 +231,8 @@ def get_downsampling_factors(dpath: Path) -> tp.Optional[tp.List[tp.List[int]]]:
 
     factors = []
 
-    while True:
-        scale += 1
-        try:
-            attrs = N5Attrs.from_dir(dpath / f"s{scale}")
-        except FileNotFoundError:
-            break
-        if not attrs.is_array():
+    for attrs in scale_attrs:
+        if attrs is None or not attrs.is_array():
             break
         shape = attrs["dimensions"]
         try:
@@ -171,30 +247,48 @@ def parse_scales(s):
     return [[int(c.strip()) for c in lvl] for lvl in s.split(";")]
 
 
-@dataclass
+@dataclass(frozen=True)
 class Length:
     magnitude: float
     unit: tp.Optional[str]
 
     @classmethod
+    @lru_cache(maxsize=256)
     def from_str(cls, s: str):
         logger.debug("Parsing length '%s'", s)
-        m = RESOLUTION_RE.match(s.strip())
-        if m is None:
-            raise ValueError(f"Resolution could not be parsed: '{s}'")
-        d = m.groupdict()
-        unit = d.get("unit")
-        if not unit:
-            unit = None
-        logger.debug("Got value %s", d["value"])
-        logger.debug("Got unit %s", unit)
-        return cls(float(d["value"]), unit)
+        length = _parse_length(s)
+        logger.debug("Got value %s", length.magnitude)
+        logger.debug("Got unit %s", length.unit)
+        return length
+
+
+def _parse_length(s: str) -> Length:
+    """Parse e.g. '1.5 nm' or '4', where the unit must be one of UNITS."""
+    stripped = s.strip()
+    value_end = 0
+    for c in stripped:
+        if c not in "0123456789.":
+            break
+        value_end += 1
+
+    try:
+        magnitude = float(stripped[:value_end])
+    except ValueError:
+        raise ValueError(f"Resolution could not be parsed: '{s}'") from None
+
+    unit = stripped[value_end:].lstrip()
+    if not unit:
+        return Length(magnitude, None)
+    if unit not in UNITS:
+        raise ValueError(f"Resolution could not be parsed: '{s}'")
+    return Length(magnitude, unit)
 
 
 def parse_resolution(s: str) -> tp.List[Length]:
     return [Length.from_str(l_str) for l_str in s.split(",")]
 
 
+@lru_cache(maxsize=64)
 def validate_unit(s: str) -> str:
     if not UNIT_RE.match(s):
         raise ValueError(f"Not a valid unit: '{s}'")
@@ -290,17 +384,20 @@ def main(args=None):
     #         downsampling.append(df)
 
     attrs = N5Attrs.from_dir(parsed.group, not parsed.force)
-    attrs["downsamplingFactors"] = downsampling
-    attrs["resolution"] = resolution
-    attrs["units"] = units
+    out = {
+        "downsamplingFactors": downsampling,
+        "resolution": resolution,
+        "units": units,
+    }
 
     if parsed.n5_viewer:
         if len(set(units)) != 1:
             raise ValueError(
                 "n5-viewer mode only available when dimensions all have the same units"
             )
-        attrs["pixelResolution"] = {"dimensions": resolution, "unit": units[0]}
+        out["pixelResolution"] = {"dimensions": resolution, "unit": units[0]}
 
+    attrs.update_trusted(out)
     attrs.to_dir(parsed.group, dry_run=parsed.dry_run)
 
 
@@ -3,11 +3,20 @@
 Script to permute BDV downscaling metadata for pasting into "Custom downsampling" field of CATMAID stack admin.
 """
 from argparse import ArgumentParser
+import os
 from pathlib import Path
-import json
+import re
+
+from n5_common import ATTRS_FILE, get_executor
+
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
 
 
 DIMS = "xyz"
+SCALE_RE = re.compile(r"s(\d+)")
 
 
 def validate_dimensions(s):
@@ -30,20 +39,23 @@ def main(args=None):
 
 
 def list_scales(path: Path):
-    name_to_level = dict()
-    for p in path.glob("s*"):
-        name = p.name
-        try:
-            level = int(name[1:])
-        except ValueError:
-            continue
-        name_to_level[name] = level
-    return sorted(name_to_level, key=name_to_level.get)
+    levels = []
+    with os.scandir(path) as it:
+        for entry in it:
+            m = SCALE_RE.fullmatch(entry.name)
+            if m is None:
+                continue
+            levels.append((int(m.group(1)), entry.name))
+    return [name for _, name in sorted(levels)]
+
+
+def read_attributes(dpath: Path):
+    with open(dpath / ATTRS_FILE, "rb") as f:
+        return _loads(f.read())
 
 
 def get_downsampling_factors(group_path):
-    with open(group_path / "attributes.json") as f:
-        attrs = json.load(f)
+    attrs = read_attributes(group_path)
 
     scales = list_scales(group_path)
 
@@ -51,9 +63,11 @@ def get_downsampling_factors(group_path):
     if factors is None:
         factors = attrs.get("scales")
     if factors is None:
-        for scale in scales:
-            with open(group_path / scale / "attributes.json") as f:
-                s_attrs = json.load(f)
+        factors = []
+        scale_attrs = get_executor().map(
+            read_attributes, [group_path / scale for scale in scales]
+        )
+        for scale, s_attrs in zip(scales, scale_attrs):
             factor = s_attrs.get("downsamplingFactors")
             if factor is None:
                 if scale == "s0":
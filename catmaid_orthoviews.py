@@ -1,38 +1,80 @@
 #!/usr/bin/env python3
 """Generate all the stack information needed for CATMAID orthoviews from an N5 scale pyramid"""
 from argparse import ArgumentParser
+import asyncio
 import logging
-from urllib.request import (
-    urlopen,
-    build_opener,
-    install_opener,
-    HTTPPasswordMgrWithDefaultRealm,
-    HTTPBasicAuthHandler,
-    Request
-)
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen, Request
+from functools import lru_cache
+import io
+from operator import itemgetter
+from types import MappingProxyType
 from typing import Optional
-import json
 import os
 import ssl
+import sys
 from base64 import b64encode
 
+from n5_common import ATTRS_FILE, ARRAY_ATTR_KEYS, MAX_WORKERS, get_executor
+
+try:
+    from orjson import loads as _loads, dumps as _dumps
+except ImportError:
+    import json
+    from json import loads as _loads
+
+    def _dumps(d, default=None) -> bytes:
+        return json.dumps(d, default=default).encode()
+
+try:
+    import urllib3
+except ImportError:
+    urllib3 = None
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 
 DIMS = "xyz"
 DIM_IDX = dict(zip(DIMS, range(3)))
 AXES_IDX = {k: f"%AXIS_{v}%" for k, v in DIM_IDX.items()}
+SLICINGS = ("xy", "xz", "zy")
+OTHER_AXIS = {"xy": "z", "xz": "y", "zy": "x"}
+DIM_ORDER = {s: s + OTHER_AXIS[s] for s in SLICINGS}
+# get (x, y, z)-ordered values in the order of each slicing's dimensions
+DIM_GETTERS = {s: itemgetter(*(DIM_IDX[d] for d in DIM_ORDER[s])) for s in SLICINGS}
+_SLICE_SLUG_H2N5 = {s: "_".join(str(DIM_IDX[d]) for d in s) for s in SLICINGS}
+_SLICE_SLUG_N5 = {s: "_".join(str(DIM_IDX[d]) for d in DIM_ORDER[s]) for s in SLICINGS}
+_AXIS_SLUG = {s: "/".join(AXES_IDX[d] for d in DIM_ORDER[s]) for s in SLICINGS}
 H2N5_TILE_SIZE = (256, 256)
 JPEG_QUALITY = 80
+_TILE_SLUG = "{}_{}".format(*H2N5_TILE_SIZE)
 logger = logging.getLogger(__name__)
 
 SSL_CONTEXT = ssl.create_default_context()
 SSL_CONTEXT.check_hostname = False
 SSL_CONTEXT.verify_mode = ssl.CERT_NONE
+SSL_CONTEXT.minimum_version = ssl.TLSVersion.TLSv1_2
+SSL_CONTEXT.options |= ssl.OP_NO_COMPRESSION
+
+if urllib3 is not None:
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    _HTTP = urllib3.PoolManager(
+        maxsize=MAX_WORKERS,
+        ssl_context=SSL_CONTEXT,
+        cert_reqs="CERT_NONE",
+        assert_hostname=False,
+    )
+else:
+    _HTTP = None
 
 
 def auth_header(user_pass: Optional[str]) -> dict[str, str]:
     d = dict()
     if user_pass is not None:
-        d["Authorization"] = b64encode(user_pass.encode()).decode()
+        d["Authorization"] = "Basic " + b64encode(user_pass.encode()).decode()
     return d
 
 
@@ -40,25 +82,50 @@ def is_url(s):
     return s.startswith("http://") or s.startswith("https://")
 
 
+def http_get(url, headers: Optional[dict[str, str]] = None) -> bytes:
+    """GET the body of a URL, reusing pooled connections if urllib3 is available."""
+    if _HTTP is None:
+        req = Request(url, headers=headers or {})
+        with urlopen(req, context=SSL_CONTEXT) as response:
+            return response.read()
+
+    try:
+        response = _HTTP.request("GET", url, headers=headers)
+    except urllib3.exceptions.HTTPError as e:
+        # match urlopen's errors
+        raise URLError(e) from e
+    if response.status >= 400:
+        raise HTTPError(url, response.status, response.reason, response.headers, None)
+    return response.data
+
+
 def _get_attributes_remote(root, item, user_pass: Optional[str]=None):
     url = join_root_item(root, item)
-    req = Request(urljoin(url, "attributes.json"), headers=auth_header(user_pass))
-    response = urlopen(req)
-    return json.loads(response.read().decode("utf-8"))
+    return _loads(http_get(urljoin(url, ATTRS_FILE), auth_header(user_pass)))
 
 
 def _get_attributes_local(root, item):
     path = join_root_item(root, item)
-    with open(os.path.join(path, "attributes.json")) as f:
-        return json.load(f)
+    with open(os.path.join(path, ATTRS_FILE), "rb") as f:
+        return _loads(f.read())
 
 
+def freeze(obj):
+    """Recursively convert decoded JSON into read-only mappings and tuples."""
+    if isinstance(obj, (dict, MappingProxyType)):
+        return MappingProxyType({k: freeze(v) for k, v in obj.items()})
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(v) for v in obj)
+    return obj
+
+
+@lru_cache(maxsize=1024)
 def get_attributes(root, item, user_pass: Optional[str]=None):
     if is_url(root):
-        return _get_attributes_remote(root, item, user_pass)
+        return freeze(_get_attributes_remote(root, item, user_pass))
     if root.startswith("file://"):
         root = root[7:]
-    return _get_attributes_local(root, item)
+    return freeze(_get_attributes_local(root, item))
 
 
 def join_root_item(root, item):
@@ -67,9 +134,140 @@ def join_root_item(root, item):
     return os.path.join(root, item.strip(os.path.sep))
 
 
-def get_group_s0_attributes(root, group, http_basic=None):
-    group_meta = get_attributes(root, group, user_pass=http_basic)
-    ds_meta = get_attributes(root, group + "/s0", user_pass=http_basic)
+def get_attributes_many(root, items, user_pass: Optional[str]=None):
+    """Get attributes for several items, fetching concurrently if the root is remote."""
+    if is_url(root) and len(items) > 1:
+        return tuple(
+            get_executor().map(lambda item: get_attributes(root, item, user_pass), items)
+        )
+    return tuple(get_attributes(root, item, user_pass) for item in items)
+
+
+class MetadataCache:
+    """Flat index of the attributes.json files under a root, persisted in a single file.
+
+    Entries are keyed by their path relative to the root,
+    which is stored alongside them so a cache is never used for the wrong root.
+    Entries for a local root record the file's modification time,
+    and are discarded if the file has since changed.
+    Remote roots cannot be checked like this: use ``refresh`` if they change.
+    """
+
+    def __init__(self, root: str, entries=None) -> None:
+        self.root = root
+        self.local = not is_url(root)
+        # key -> [mtime_ns or None, attributes]
+        self.entries = dict() if entries is None else entries
+        self.dirty = False
+
+    @staticmethod
+    def key(item: str) -> str:
+        item = item.replace(os.path.sep, "/").strip("/")
+        if item in ("", "."):
+            return ATTRS_FILE
+        return f"{item}/{ATTRS_FILE}"
+
+    def mtime_ns(self, item: str) -> Optional[int]:
+        """Modification time of the item's attributes file, or None if remote or missing."""
+        if not self.local:
+            return None
+        try:
+            return os.stat(os.path.join(self.root, self.key(item))).st_mtime_ns
+        except OSError:
+            return None
+
+    def get(self, item: str):
+        key = self.key(item)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        mtime_ns, d = entry
+        if self.local and self.mtime_ns(item) != mtime_ns:
+            del self.entries[key]
+            self.dirty = True
+            return None
+        return d
+
+    def set(self, item: str, d, mtime_ns: Optional[int] = None):
+        """Add an item's attributes; for local roots, give the mtime from before they were read."""
+        self.entries[self.key(item)] = [mtime_ns, d]
+        self.dirty = True
+
+    @classmethod
+    def from_walk(cls, root: str):
+        """Read every attributes.json under a local root, without descending into arrays."""
+        cache = cls(root)
+        for dirpath, dirnames, filenames in os.walk(root):
+            if ATTRS_FILE not in filenames:
+                continue
+            with open(os.path.join(dirpath, ATTRS_FILE), "rb") as f:
+                mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+                d = _loads(f.read())
+            cache.set(os.path.relpath(dirpath, root), d, mtime_ns)
+            if ARRAY_ATTR_KEYS.issubset(d):
+                # arrays only contain chunks
+                dirnames.clear()
+        return cache
+
+    @classmethod
+    def load(cls, fpath, root: str, refresh=False):
+        """Read the cache file for this root, or build a new cache.
+
+        A new cache is built if the file does not exist, is for a different root
+        or an older format, or ``refresh`` is given.
+        Local roots are walked to populate it;
+        remote roots cannot be listed, so start empty.
+        Nothing is written: ``dump`` the cache if it is ``dirty``.
+        """
+        if not refresh:
+            try:
+                with open(fpath, "rb") as f:
+                    d = _loads(f.read())
+            except FileNotFoundError:
+                pass
+            else:
+                if d.get("root") == root and "entries" in d:
+                    return cls(root, d["entries"])
+                logger.warning(
+                    "Metadata cache %s is not for %s, rebuilding", fpath, root
+                )
+
+        if is_url(root):
+            cache = cls(root)
+        else:
+            logger.info("Building metadata cache for %s", root)
+            cache = cls.from_walk(root)
+        cache.dirty = True
+        return cache
+
+    def dump(self, fpath):
+        with open(fpath, "wb") as f:
+            # entries may be read-only mappings
+            f.write(_dumps({"root": self.root, "entries": self.entries}, default=dict))
+        self.dirty = False
+
+
+def cache_root(root):
+    """Normalise a container root to identify its metadata cache."""
+    if is_url(root):
+        return root.rstrip("/")
+    if root.startswith("file://"):
+        root = root[7:]
+    return os.path.abspath(root)
+
+
+def get_group_s0_attributes(root, group, http_basic=None, cache=None):
+    items = (group, group + "/s0")
+    if cache is None:
+        group_meta, ds_meta = get_attributes_many(root, items, user_pass=http_basic)
+        return group_meta, ds_meta
+
+    missing = [item for item in items if cache.get(item) is None]
+    mtimes = [cache.mtime_ns(item) for item in missing]
+    fetched = get_attributes_many(root, missing, user_pass=http_basic)
+    for item, mtime_ns, attrs in zip(missing, mtimes, fetched):
+        cache.set(item, attrs, mtime_ns)
+    group_meta, ds_meta = (freeze(cache.get(item)) for item in items)
     return group_meta, ds_meta
 
 
@@ -82,10 +280,12 @@ def main(args=None):
     )
     parser.add_argument(
         "root",
+        nargs="?",
         help="Path or URL to the root of the N5 container",
     )
     parser.add_argument(
         "group",
+        nargs="?",
         help=(
             "Fully qualified name of the multiscale group within the container. "
             "This group should contain scales s0, s1 etc.."
@@ -116,16 +316,71 @@ def main(args=None):
             "as 'username:password'."
         ),
     )
+    parser.add_argument(
+        "--pairs",
+        "-p",
+        help=(
+            "Instead of root and group, give a file with one 'root group' pair per line "
+            "('-' for stdin), to print information for all of them. "
+            "Their metadata is fetched concurrently."
+        ),
+    )
+    parser.add_argument(
+        "--metadata-cache",
+        "-c",
+        help=(
+            "File in which to cache attributes from the container, to avoid re-reading them. "
+            "Built if it does not exist or is for another container."
+        ),
+    )
+    parser.add_argument(
+        "--refresh-cache",
+        action="store_true",
+        help="Rebuild the metadata cache even if it exists.",
+    )
     parsed = parser.parse_args(args)
 
+    if parsed.pairs is not None:
+        if parsed.root is not None:
+            parser.error("root and group cannot be given with --pairs")
+        if parsed.metadata_cache:
+            parser.error("--metadata-cache cannot be used with --pairs")
+        if parsed.pairs == "-":
+            roots, groups = read_root_groups(sys.stdin)
+        else:
+            with open(parsed.pairs) as f:
+                roots, groups = read_root_groups(f)
+        _main_many(
+            roots,
+            groups,
+            parsed.h2n5_root,
+            parsed.no_n5,
+            parsed.http_basic_auth,
+        )
+        return
+
+    if parsed.group is None:
+        parser.error("root and group are required unless --pairs is given")
+
+    cache = None
+    if parsed.metadata_cache:
+        cache = MetadataCache.load(
+            parsed.metadata_cache, cache_root(parsed.root), parsed.refresh_cache
+        )
+
+    get_attributes.cache_clear()
     _main(
         parsed.root,
         parsed.group,
         parsed.h2n5_root,
         parsed.no_n5,
         parsed.http_basic_auth,
+        cache,
     )
 
+    if cache is not None and cache.dirty:
+        cache.dump(parsed.metadata_cache)
+
 
 def urljoin(base, *items):
     url = base.rstrip("/")
@@ -135,42 +390,24 @@ def urljoin(base, *items):
 
 
 def get_other_axis(slicing):
-    return (set(DIMS) - set(slicing)).pop()
+    return OTHER_AXIS[slicing]
 
 
 def make_h2n5_url(h2n5_base, group, slicing="xy"):
-    depth = get_other_axis(slicing)
-    slice_slug = "_".join(str(DIM_IDX[s]) for s in slicing)
-    tile_slug = "{}_{}".format(*H2N5_TILE_SIZE)
-    axis_slug = "/".join(AXES_IDX[d] for d in slicing + depth)
-    return urljoin(
-        h2n5_base, "tile", group, "%SCALE_DATASET%", slice_slug, tile_slug, axis_slug
+    return (
+        f"{h2n5_base.rstrip('/')}/tile/{group.strip('/')}/%SCALE_DATASET%/"
+        f"{_SLICE_SLUG_H2N5[slicing]}/{_TILE_SLUG}/{_AXIS_SLUG[slicing]}"
     )
 
 
 def make_n5_url(path, slicing="xy"):
-    if is_url(path):
-        fn = urljoin
-    else:
-        fn = os.path.join
-
-    depth = get_other_axis(slicing)
-    slice_slug = "_".join(str(DIM_IDX[s]) for s in slicing + depth)
-
-    return fn(path, "%SCALE_DATASET%", slice_slug)
-
-
-def dict_in_order(d, keys):
-    return [d[k] for k in keys]
+    sep = "/" if is_url(path) else os.path.sep
+    return f"{path.rstrip(sep)}{sep}%SCALE_DATASET%{sep}{_SLICE_SLUG_N5[slicing]}"
 
 
 def format_downsampling(factors, slicing="xy"):
-    full_slicing = slicing + get_other_axis(slicing)
-    items = []
-    for factor in factors:
-        inner = ",".join(str(f) for f in dict_in_order(factor, full_slicing))
-        items.append(f"{inner}")
-    return "|".join(items)
+    getter = DIM_GETTERS[slicing]
+    return "|".join(",".join(map(str, getter(factor))) for factor in factors)
 
 
 def megatitle(s):
@@ -182,39 +419,139 @@ def title(s):
     return f"{s}\n{'-'*len(s)}"
 
 
-def _main(root, group, h2n5_root=None, no_n5=False, http_basic=None):
-    group_meta, s0_meta = get_group_s0_attributes(root, group, http_basic)
-
-    dims = dict(zip(DIMS, s0_meta["dimensions"]))
-    res = dict(zip(DIMS, group_meta["resolution"]))
-    factors = [dict(zip(DIMS, f)) for f in group_meta["downsamplingFactors"]]
+def write_orthoviews(
+    f, root, group, group_meta, s0_meta, h2n5_root=None, no_n5=False
+):
+    dims = s0_meta["dimensions"]
+    res = group_meta["resolution"]
+    factors = group_meta["downsamplingFactors"]
 
     url = join_root_item(root, group)
     if not is_url(url) and not url.startswith("file://"):
         url = "file://" + url
 
-    rows = []
-    for slicing in ["xy", "xz", "zy"]:
-        rows.append(slicing.upper())
-        dim_order = slicing + get_other_axis(slicing)
-        rows.append(megatitle(slicing))
-        rows.append(
-            "Dimension: "
-            + "X: {}\tY: {}\tZ: {}".format(*dict_in_order(dims, dim_order))
-        )
-        rows.append(
-            "Resolution: "
-            + "X: {}\tY: {}\tZ: {}".format(*dict_in_order(res, dim_order))
-        )
-        rows.append("Downsampling: " + format_downsampling(factors, slicing))
+    w = f.write
+    for i, slicing in enumerate(SLICINGS):
+        if i:
+            w("\n")
+        getter = DIM_GETTERS[slicing]
+        w(f"{slicing.upper()}\n{megatitle(slicing)}\n")
+        w("Dimension: X: {}\tY: {}\tZ: {}\n".format(*getter(dims)))
+        w("Resolution: X: {}\tY: {}\tZ: {}\n".format(*getter(res)))
+        w(f"Downsampling: {format_downsampling(factors, slicing)}\n")
         if h2n5_root:
-            rows.append("H2N5 URL: " + make_h2n5_url(h2n5_root, group, slicing))
-            rows.append(f"H2N5 file extension: jpg?q={JPEG_QUALITY}")
+            w(f"H2N5 URL: {make_h2n5_url(h2n5_root, group, slicing)}\n")
+            w(f"H2N5 file extension: jpg?q={JPEG_QUALITY}\n")
         if not no_n5:
-            rows.append("N5 URL: " + make_n5_url(url, slicing))
-        rows.append("")
-    rows.pop()
-    print("\n".join(rows))
+            w(f"N5 URL: {make_n5_url(url, slicing)}\n")
+
+
+def _main(root, group, h2n5_root=None, no_n5=False, http_basic=None, cache=None):
+    group_meta, s0_meta = get_group_s0_attributes(root, group, http_basic, cache)
+
+    buf = io.StringIO()
+    write_orthoviews(buf, root, group, group_meta, s0_meta, h2n5_root, no_n5)
+    sys.stdout.write(buf.getvalue())
+
+
+async def _get_attributes_async(session, root, item, user_pass: Optional[str]=None):
+    if session is None or not is_url(root):
+        return await asyncio.to_thread(get_attributes, root, item, user_pass)
+    url = urljoin(join_root_item(root, item), ATTRS_FILE)
+    try:
+        async with session.get(url, headers=auth_header(user_pass)) as response:
+            if response.status >= 400:
+                raise HTTPError(
+                    url, response.status, response.reason, response.headers, None
+                )
+            data = await response.read()
+    except aiohttp.ClientError as e:
+        # match the synchronous fetchers' errors
+        raise URLError(e) from e
+    return freeze(_loads(data))
+
+
+async def _amain(roots, groups, http_basic=None):
+    """Concurrently get the group and s0 attributes for every (root, group) pair.
+
+    Each (root, item) is only requested once, however many pairs share it.
+    Failed requests give their exception instead of attributes.
+    Remote requests share an aiohttp session if aiohttp is installed;
+    otherwise, every request is run in a thread.
+    """
+    pair_items = [
+        ((root, group), (root, group + "/s0")) for root, group in zip(roots, groups)
+    ]
+    # dict preserves order, unlike set
+    items = list(dict.fromkeys(item for pair in pair_items for item in pair))
+
+    async def gather(session):
+        return await asyncio.gather(
+            *(
+                _get_attributes_async(session, root, item, http_basic)
+                for root, item in items
+            ),
+            return_exceptions=True,
+        )
+
+    if aiohttp is None or not any(is_url(root) for root in roots):
+        metas = await gather(None)
+    else:
+        connector = aiohttp.TCPConnector(limit=MAX_WORKERS, ssl=SSL_CONTEXT)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            metas = await gather(session)
+
+    item_metas = dict(zip(items, metas))
+    return [tuple(item_metas[item] for item in pair) for pair in pair_items]
+
+
+def read_root_groups(f):
+    """Read whitespace-separated 'root group' pairs, one per line.
+
+    Blank lines and lines starting with '#' are ignored.
+    """
+    roots = []
+    groups = []
+    for line_no, line in enumerate(f, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        fields = line.split()
+        if len(fields) != 2:
+            raise ValueError(f"Line {line_no} is not 'root group': '{line}'")
+        roots.append(fields[0])
+        groups.append(fields[1])
+    return roots, groups
+
+
+def _main_many(roots, groups, h2n5_root=None, no_n5=False, http_basic=None):
+    metas = asyncio.run(_amain(roots, groups, http_basic))
+
+    buf = io.StringIO()
+    n_failed = 0
+    for i, (root, group, (group_meta, s0_meta)) in enumerate(zip(roots, groups, metas)):
+        if i:
+            buf.write("\n")
+        buf.write(f"{title(join_root_item(root, group))}\n\n")
+        try:
+            for meta in (group_meta, s0_meta):
+                if isinstance(meta, BaseException):
+                    raise meta
+            pair_buf = io.StringIO()
+            write_orthoviews(
+                pair_buf, root, group, group_meta, s0_meta, h2n5_root, no_n5
+            )
+        except Exception as e:
+            n_failed += 1
+            buf.write(f"Error: {type(e).__name__}: {e}\n")
+        else:
+            buf.write(pair_buf.getvalue())
+    sys.stdout.write(buf.getvalue())
+
+    if n_failed:
+        sys.exit(
+            f"Could not get stack information for {n_failed} of {len(metas)} groups"
+        )
 
 
 if __name__ == "__main__":
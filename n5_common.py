@@ -0,0 +1,17 @@
+"""Definitions shared by the scripts in this directory."""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+ATTRS_FILE = "attributes.json"
+ARRAY_ATTR_KEYS = {"dimensions", "dataType", "blockSize", "compression"}
+MAX_WORKERS = 16
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Get the process-wide thread pool, creating it on first use."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    return _executor